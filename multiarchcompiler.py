@@ -1,4 +1,3 @@
-import json
 import subprocess
 import argparse
 import sys
@@ -7,58 +6,70 @@ import os
 import random
 import string
 import tempfile
+import shutil
+import shlex
+import re
 import time
 import atexit
+import threading
+import concurrent.futures
+import collections
+import urllib.request
+import urllib.error
+try:
+    import orjson as json
+except ImportError:
+    import json
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-options = {
-        "volumes": {
-            "type": list,
-            "required": True,
-            "default": "(none)",
-            "help": "should be an list of strings following docker volume format"
-        },
-        "dockerargs": {
-            "type": str,
-            "required": False,
-            "default": "",
-            "help": "additional arguments to pass to docker"
-        },
-        "arches": {
-            "type": list,
-            "required": True,
-            "default": "(none)",
-            "help": "an list of strings containing the arches you want to compile for"
-        },
-        "image": {
-            "type": str,
-            "required": True,
-            "default": "(none)",
-            "help": "the image to use"
-        },
-        "containername": {
-            "type": str,
-            "required": False,
-            "default": "{random}-{arch}",
-            "help": "the name format for naming the docker containers"
-        },
-        "build": {
-            "type": str,
-            "required": True,
-            "default": "(none)",
-            "help": "path to the script to compile your program"
-        },
-        "removecontainers": {
-            "type": bool,
-            "required": False,
-            "default": True,
-            "help": "remove the containers after the compilation has completed"
-        }
-}
+Option = collections.namedtuple('Option', 'name type required default help')
+
+OPTIONS = (
+    Option('volumes', list, True, '(none)',
+           'should be an list of strings following docker volume format, $NAME and ${NAME} environment variables are expanded (other shell syntax is rejected)'),
+    Option('dockerargs', str, False, '',
+           'additional arguments to pass to docker, $NAME and ${NAME} environment variables are expanded (other shell syntax like ~ is rejected)'),
+    Option('arches', list, True, '(none)',
+           'an list of strings containing the arches you want to compile for'),
+    Option('image', str, True, '(none)',
+           'the image to use'),
+    Option('containername', str, False, '{random}-{arch}',
+           'the name format for naming the docker containers'),
+    Option('build', str, True, '(none)',
+           'path to the script to compile your program'),
+    Option('removecontainers', bool, False, True,
+           'remove the containers after the compilation has completed'),
+    Option('registrycache', bool, False, False,
+           'pull images through a local docker hub pull-through cache on localhost:5000'),
+    Option('cacheimage', str, False, '',
+           'if set, the container of the first successful build is saved as this image and used instead of image on later runs, delete the image to refresh it (the build script should be safe to rerun)'),
+)
+
+MISSING = object()
+
+# the options that can contain "{arch}" and "{random}"
+TEMPLATEOPTIONS = ('containername', 'image', 'dockerargs', 'build', 'cacheimage')
+
+REGISTRYCACHE = 'localhost:5000'
+REGISTRYCACHENAME = 'multiarchcompiler-registrycache'
+
+# label recording which image a cacheimage snapshot was made from
+SNAPSHOTLABEL = 'multiarchcompiler.base'
+
+
+def positiveInt(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'must be a number, got {value}')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {value}')
+    return number
+
 
 parser = argparse.ArgumentParser(
     prog='Multi Arch Compiler',
@@ -71,8 +82,14 @@ parser.add_argument('-v', '--verbose', action='store_true',
                     help='explain in more detail what this script is doing')
 parser.add_argument('-V', '--version', action='store_true',
                     help='print version and exit')
+parser.add_argument('-j', '--jobs', type=positiveInt,
+                    help='number of arches to build at the same time (default: all of them)')
+parser.add_argument('--noprefetch', action='store_true',
+                    help='don\'t pull all the images before starting the builds')
 parser.add_argument('--ignorewarnings', action='store_true',
                     help='override warnings')
+parser.add_argument('--skipchecks', action='store_true',
+                    help='skip the platform, root user and docker checks')
 parser.add_argument('--confighelp', action='store_true',
                     help='prints the guide for making a configuration file')
 args = parser.parse_args()
@@ -84,19 +101,19 @@ if args.version:
 if args.confighelp:
     print('The config should be a valid json file containing information on what to do')
     print('')
-    print('The following variables are available in the following properties: containername, image, dockerargs, build:')
+    print('The following variables are available in the following properties: ' + ', '.join(TEMPLATEOPTIONS) + ':')
     print('')
     print('"{arch}" - the arch that it is currently compiling for')
     print('"{random}" - a random string of 20 characters')
     print('')
     print('Config file properties:')
     print('')
-    for key in options:
-        print(f'{key}:')
-        print('    Type: {r}'.format(r=str(options[key]['type'].__name__)))
-        print('    Required: {r}'.format(r=str(options[key]['required'])))
-        print('    Default: {r}'.format(r=str(options[key]['default'])))
-        print('    Description: {r}'.format(r=str(options[key]['help'])))
+    for option in OPTIONS:
+        print(f'{option.name}:')
+        print(f'    Type: {option.type.__name__}')
+        print(f'    Required: {option.required}')
+        print(f'    Default: {option.default}')
+        print(f'    Description: {option.help}')
         print('')
     exit()
 
@@ -105,13 +122,19 @@ if not args.configfile:
     exit(1)
 
 LOGFILE = False
-try:
-    LOGFILE = open(args.logfile, mode='a')
-except:
+BUILDDIR = False
+if args.logfile:
+    try:
+        LOGFILE = open(args.logfile, mode='a', buffering=1, encoding='utf-8')
+    except OSError as e:
+        eprint(f'not logging to a file: {e}')
+else:
     eprint('not logging to a file')
 
 
 def exit_handler():
+    if BUILDDIR:
+        shutil.rmtree(BUILDDIR, ignore_errors=True)
     if LOGFILE:
         LOGFILE.close()
 
@@ -122,47 +145,194 @@ if LOGFILE:
     LOGFILE.write(f'\n\nnew log {time.ctime()}\n\n')
 
 
+LOGLOCK = threading.Lock()
+
+
 def errorLogPrint(*args, **kwargs):
-    if LOGFILE:
-        print(*args, file=LOGFILE, **kwargs)
-    eprint(*args, **kwargs)
+    with LOGLOCK:
+        if LOGFILE:
+            print(*args, file=LOGFILE, **kwargs)
+        eprint(*args, **kwargs)
 
 
 def logPrint(*args, **kwargs):
-    if LOGFILE:
-        print(*args, file=LOGFILE, **kwargs)
-    print(*args, **kwargs)
+    with LOGLOCK:
+        if LOGFILE:
+            print(*args, file=LOGFILE, **kwargs)
+        print(*args, **kwargs)
+
+
+LETTERS = string.ascii_lowercase
 
 
 def randomstr(length):
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(length))
+    return ''.join(random.choices(LETTERS, k=length))
+
+
+def commandNotFound(command):
+    errorLogPrint(f'{command[0]}: not found. exiting...')
+    exit(1)
 
 
 def execCommand(command, **args2):
     if args.verbose:
-        logPrint('run command: ' + command)
-    return subprocess.run(command, **args2)
+        logPrint('run command: ' + shlex.join(command))
+    try:
+        return subprocess.run(command, **args2)
+    except FileNotFoundError:
+        commandNotFound(command)
 
 
-def formatStringArch(arch, string):
-    return string.replace('{arch}', arch).replace('{random}', randomstr(20))
+def streamCommand(command, prefix):
+    if args.verbose:
+        logPrint('run command: ' + shlex.join(command))
+    try:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace', bufsize=1)
+    except FileNotFoundError:
+        commandNotFound(command)
+    try:
+        for line in proc.stdout:
+            logPrint(prefix + line.rstrip('\n'))
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    return returncode
+
+
+def compileTemplate(string):
+    return ('{arch}' in string, '{random}' in string, string)
+
+
+def formatStringArch(arch, template, rnd=None):
+    hasarch, hasrandom, string = template
+    if hasarch:
+        string = string.replace('{arch}', arch)
+    if hasrandom:
+        if rnd is None:
+            rnd = randomstr(20)
+        string = string.replace('{random}', rnd)
+    return string
+
+
+def registryImage(image):
+    if not config['registrycache']:
+        return image
+    first = image.split('/')[0]
+    if '/' in image and ('.' in first or ':' in first or first == 'localhost'):
+        # the user already specified a registry
+        return image
+    if '/' not in image:
+        image = 'library/' + image
+    return REGISTRYCACHE + '/' + image
+
+
+def snapshotBase(image):
+    # returns the base image a cacheimage snapshot was made from, '' if it
+    # has no label and None if the image doesn't exist
+    r = execCommand(['docker', 'image', 'inspect', '-f', '{{json .Config.Labels}}', image],
+                    capture_output=True, text=True)
+    if r.returncode != 0:
+        return None
+    try:
+        labels = json.loads(r.stdout) or {}
+    except ValueError:
+        return ''
+    return labels.get(SNAPSHOTLABEL, '')
+
+
+def resolveImage(arch, rnd):
+    # returns the image to build with and whether it is a cacheimage snapshot
+    base = registryImage(formatStringArch(arch, templates['image'], rnd))
+    if config['cacheimage']:
+        image = formatStringArch(arch, templates['cacheimage'], rnd)
+        snapshotbase = snapshotBase(image)
+        if snapshotbase == base:
+            return (image, True)
+        if snapshotbase is not None:
+            logPrint(f'ignoring cache image "{image}" for {arch}, it was not made from "{base}"')
+    return (base, False)
+
+
+def waitForRegistryCache(timeout=30):
+    # talk to the registry directly even if an http proxy is configured
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            opener.open(f'http://{REGISTRYCACHE}/v2/', timeout=1).close()
+            return True
+        except urllib.error.HTTPError:
+            # any http response means the registry is listening
+            return True
+        except OSError:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.5)
+
+
+def startRegistryCache():
+    if execCommand(['docker', 'start', REGISTRYCACHENAME], capture_output=True).returncode == 0:
+        return waitForRegistryCache()
+    r = execCommand(['docker', 'run', '-d', '--restart=always', '--name', REGISTRYCACHENAME, '-p', '127.0.0.1:5000:5000',
+                     '-v', f'{REGISTRYCACHENAME}:/var/lib/registry',
+                     '-e', 'REGISTRY_PROXY_REMOTEURL=https://registry-1.docker.io', 'registry:2'],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if r.returncode != 0:
+        errorLogPrint('[registry cache output]: ' + '\n[registry cache output]: '.join(r.stdout.split('\n')))
+        return False
+    return waitForRegistryCache()
+
+
+def checkVariables(key, value):
+    # values are expanded with os.path.expandvars, which only knows $NAME and
+    # ${NAME} and silently leaves everything else as it is
+    if '$(' in value or '`' in value:
+        return f'The option "{key}" uses command substitution, which is not supported\n'
+    for match in re.finditer(r'\$(?:\{([^}]*)\}|(\w+))', value):
+        name = match.group(2) if match.group(1) is None else match.group(1)
+        if not re.fullmatch(r'\w+', name):
+            return f'The option "{key}" uses "{match.group(0)}" but only $NAME and ${{NAME}} are supported\n'
+        if name not in os.environ:
+            return f'The option "{key}" uses the environment variable "{name}" which is not set\n'
+    return ''
 
 
 def validateConfig(config):
     errors = ''
-    for key in options:
-        try:
-            config[key]
-            if not type(config[key]) == options[key]['type']:
-                errors += 'The option "' + key + '" is type "' + \
-                    type(config[key]).__name__ + '" but it should be of type "' + \
-                    options[key]['type'].__name__ + '"\n'
-        except KeyError:
-            if options[key]['required']:
-                errors += 'The required option "' + key + '" is not found\n'
+    for option in OPTIONS:
+        value = config.get(option.name, MISSING)
+        if value is MISSING:
+            if option.required:
+                errors += 'The required option "' + option.name + '" is not found\n'
             else:
-                config[key] = options[key]['default']
+                config[option.name] = option.default
+        elif type(value) is not option.type:
+            errors += 'The option "' + option.name + '" is type "' + \
+                type(value).__name__ + '" but it should be of type "' + \
+                option.type.__name__ + '"\n'
+    if type(config.get('volumes')) is list:
+        for volume in config['volumes']:
+            if type(volume) is str:
+                errors += checkVariables('volumes', volume)
+    if type(config.get('dockerargs')) is str:
+        errors += checkVariables('dockerargs', config['dockerargs'])
+        try:
+            words = shlex.split(config['dockerargs'])
+        except ValueError as e:
+            errors += f'The option "dockerargs" can\'t be split into arguments: {e}\n'
+        else:
+            if any(word.startswith('~') or '=~' in word for word in words):
+                errors += 'The option "dockerargs" uses "~" which is not expanded, use $HOME instead\n'
+    if type(config.get('cacheimage')) is str and '{random}' in config['cacheimage']:
+        errors += 'The option "cacheimage" can\'t contain "{random}", the cache image would never be reused\n'
+    if type(config.get('arches')) is list:
+        duplicates = []
+        for arch in config['arches']:
+            if config['arches'].count(arch) > 1 and arch not in duplicates:
+                duplicates.append(arch)
+        if duplicates:
+            errors += 'The option "arches" lists "' + '", "'.join(duplicates) + '" more than once\n'
     if len(errors):
         errorLogPrint(
             'The following errors were found while attempting to parse the config file:\n' + errors)
@@ -170,50 +340,56 @@ def validateConfig(config):
     return config
 
 
-if args.verbose:
-    logPrint('testing platform...')
-platformok = platform.architecture()[0] == '64bit' and (
-    platform.system() == 'Linux' or platform.system() == 'Darwin')
-
-if not platformok and not args.ignorewarnings:
-    errorLogPrint(
-        'This script only works on 64bit Linux or Darwin. exiting...\nuse --ignorewarnings to override this')
-    exit(1)
-
-if args.verbose:
-    logPrint('testing if the user id root...')
-userok = False
-try:
-    userok = os.getuid() == 0
-except:
-    errorLogPrint('os.getuid() doesn\'t appear to exist')
+if not args.skipchecks:
+    if args.verbose:
+        logPrint('testing platform...')
+    # sys.maxsize avoids platform.architecture(), which runs `file` on some systems
+    platformok = sys.maxsize > 2**32 and platform.system() in ('Linux', 'Darwin')
 
-if not userok and not args.ignorewarnings:
-    errorLogPrint(
-        'detect current user is not root, must be run as root. exiting...\nuse --ignorewarnings to override this')
-    exit(1)
+    if not platformok and not args.ignorewarnings:
+        errorLogPrint(
+            'This script only works on 64bit Linux or Darwin. exiting...\nuse --ignorewarnings to override this')
+        exit(1)
 
-if args.verbose:
-    logPrint('testing for docker...')
-dockerok = subprocess.run('docker --version', shell=True).returncode == 0
+    if args.verbose:
+        logPrint('testing if the user id root...')
+    userok = False
+    try:
+        userok = os.getuid() == 0
+    except AttributeError:
+        errorLogPrint('os.getuid() doesn\'t appear to exist')
+
+    if not userok and not args.ignorewarnings:
+        errorLogPrint(
+            'detect current user is not root, must be run as root. exiting...\nuse --ignorewarnings to override this')
+        exit(1)
 
-if not dockerok and not args.ignorewarnings:
-    errorLogPrint(
-        'docker not found. exiting...\nuse --ignorewarnings to override this')
-    exit(1)
+    if args.verbose:
+        logPrint('testing for docker...')
+    try:
+        dockerok = subprocess.run(['docker', '--version'], stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL).returncode == 0
+    except FileNotFoundError:
+        dockerok = False
+
+    if not dockerok and not args.ignorewarnings:
+        errorLogPrint(
+            'docker not found. exiting...\nuse --ignorewarnings to override this')
+        exit(1)
 
 if args.verbose:
     logPrint('opening config file...')
 
 try:
-    f = open(args.configfile)
+    with open(args.configfile, 'rb') as f:
+        configdata = f.read()
 except FileNotFoundError:
     errorLogPrint('cannot open the config file!')
     exit(1)
 
 try:
-    config = json.loads(f.read())
-except json.decoder.JSONDecodeError:
+    config = json.loads(configdata)
+except ValueError:
     errorLogPrint(
         'failed to parse the json, is the config file a valid json file?')
     exit(1)
@@ -223,36 +399,103 @@ config = validateConfig(config)
 if args.verbose:
     logPrint('config file valid')
 
-logPrint('setting up qemu-user-static...')
-QEMUoutput = execCommand('docker run --rm --privileged multiarch/qemu-user-static --reset -p yes', shell=True, capture_output=True, text=True)
-logPrint('[qemu-user-static output]: ' + '\n[qemu-user-static output]: '.join(QEMUoutput.stdout.split('\n')))
-
-volumes = ''
+templates = {key: compileTemplate(config[key]) for key in TEMPLATEOPTIONS}
 
-for volume in config['volumes']:
-    volumes += f'-v "{volume}"'
+# one random string per arch so every "{random}" of an arch gets the same value
+randoms = {arch: randomstr(20) for arch in config['arches']}
 
+missing = []
 for arch in config['arches']:
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        logPrint('building for ' + arch)
-        try:
-            file = open(formatStringArch(arch, config['build']))
-        except FileNotFoundError:
-            errorLogPrint('cannot find build script "' +
-                          formatStringArch(arch, config['build']) + '"')
-            exit(1)
-        file2 = open(tmpdirname + '/build.sh', mode='w')
-        file2.write(file.read())
-        file2.close()
-        file.close()
-        rm = ''
+    buildscript = formatStringArch(arch, templates['build'], randoms[arch])
+    if not os.path.isfile(buildscript) or not os.access(buildscript, os.R_OK):
+        missing.append(buildscript)
+if missing:
+    errorLogPrint('cannot find build script "' + '", "'.join(missing) + '"')
+    exit(1)
+
+# builds running at the same time can't share a container name
+if min(args.jobs or len(config['arches']), len(config['arches'])) > 1:
+    names = {formatStringArch(arch, templates['containername'], randoms[arch]) for arch in config['arches']}
+    if len(names) < len(config['arches']):
+        errorLogPrint('containername must contain "{arch}" or "{random}" when building more than one arch at a time\nuse --jobs 1 to build one arch at a time')
+        exit(1)
+
+if config['registrycache']:
+    logPrint('starting the registry cache...')
+    if not startRegistryCache():
+        errorLogPrint('failed to start the registry cache')
+        exit(1)
+
+logPrint('setting up qemu-user-static...')
+streamCommand(['docker', 'run', '--rm', '--privileged', registryImage('multiarch/qemu-user-static'), '--reset', '-p', 'yes'],
+              '[qemu-user-static output]: ')
+
+volumes = [arg for volume in config['volumes'] for arg in ('-v', os.path.expandvars(volume))]
+
+
+def pullImage(image):
+    r = execCommand(['docker', 'pull', image], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if r.returncode != 0:
+        errorLogPrint(f'[docker pull output ({image})]: ' + f'\n[docker pull output ({image})]: '.join(r.stdout.split('\n')))
+    return r.returncode == 0
+
+
+images = {arch: resolveImage(arch, randoms[arch]) for arch in config['arches']}
+
+if not args.noprefetch:
+    pulls = {image for image, fromsnapshot in images.values() if not fromsnapshot}
+    logPrint('pulling ' + str(len(pulls)) + ' images...')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs or len(pulls) or 1) as executor:
+        list(executor.map(pullImage, pulls))
+
+# /dev/shm is RAM backed so the build scripts never touch the disk
+BUILDDIR = tempfile.mkdtemp(prefix='multiarchcompiler-',
+                            dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+def buildArch(arch):
+    rnd = randoms[arch]
+    tmpdirname = os.path.join(BUILDDIR, arch)
+    os.makedirs(tmpdirname, exist_ok=True)
+    logPrint('building for ' + arch)
+    shutil.copyfile(formatStringArch(arch, templates['build'], rnd), os.path.join(tmpdirname, 'build.sh'))
+    name = formatStringArch(arch, templates['containername'], rnd)
+    image, fromsnapshot = images[arch]
+    if fromsnapshot:
+        logPrint(f'using cache image "{image}" for {arch}')
+    # only snapshot builds from the base image, committing on top of the
+    # cache image would stack one more layer onto it every run
+    cacheimage = ''
+    if config['cacheimage'] and not fromsnapshot:
+        cacheimage = formatStringArch(arch, templates['cacheimage'], rnd)
+    rm = []
+    if config['removecontainers'] and not cacheimage:
+        # the container is needed after the build to save the cache image
+        rm = ['--rm']
+    returncode = streamCommand(['docker', 'run', *rm,
+                                '-v', f'{tmpdirname}:/buildcommand',
+                                '--name', name,
+                                *volumes,
+                                *shlex.split(os.path.expandvars(formatStringArch(arch, templates['dockerargs'], rnd))),
+                                image,
+                                'bash', '/buildcommand/build.sh'], f'[docker output ({arch})]: ')
+    if cacheimage:
+        if returncode == 0:
+            logPrint(f'saving cache image "{cacheimage}" for {arch}')
+            if execCommand(['docker', 'commit', '--change', f'LABEL {SNAPSHOTLABEL}="{image}"', name, cacheimage],
+                           stdout=subprocess.DEVNULL).returncode != 0:
+                errorLogPrint(f'failed to save cache image "{cacheimage}"')
         if config['removecontainers']:
-            rm = '--rm'
-        r = execCommand('docker run {rm} -v "{tmpdir}:/buildcommand" --name "{name}" {volumes} {dockerargs} "{image}" bash /buildcommand/build.sh 2>&1'.format(
-            name=formatStringArch(arch, config['containername']),
-            image=formatStringArch(arch, config['image']),
-            tmpdir=tmpdirname,
-            dockerargs=formatStringArch(arch, config['dockerargs']),
-            volumes=volumes,
-            rm=rm), shell=True, capture_output=True, text=True)
-        logPrint('[docker output]: ' + '\n[docker output]: '.join(r.stdout.split('\n')))
\ No newline at end of file
+            execCommand(['docker', 'rm', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (arch, returncode)
+
+
+failed = []
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs or len(config['arches']) or 1) as executor:
+    for arch, returncode in executor.map(buildArch, config['arches']):
+        if returncode != 0:
+            failed.append(arch)
+
+if failed:
+    errorLogPrint('the build failed for: ' + ', '.join(failed))
+    exit(1)